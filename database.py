@@ -4,24 +4,109 @@ Database module for MSSQL Server operations in Azure Functions
 Handles async connections and queries to bim_transaction table
 """
 import aioodbc
+import pyodbc
 import asyncio
 import os
-from typing import List, Dict, Any, Optional
+from typing import List, Optional
 import logging
+from cachetools import TTLCache
+from collections import namedtuple
 from datetime import datetime
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+# aioodbc manages its own pool; disable the ODBC driver manager pooling underneath it
+pyodbc.pooling = False
+
 logger = logging.getLogger(__name__)
 
+# Row returned by get_transaction_by_id, in MSSQLDatabase._SELECT_TXN_SQL column order
+TxnRow = namedtuple("TxnRow", [
+    "transaction_id",
+    "stamp",
+    "total_amount",
+    "consumer_id",
+    "terminal_id",
+    "approval_code",
+    "fname",
+    "lname",
+    "address1",
+    "address2",
+    "city",
+    "state",
+    "zip",
+    "home_phone",
+    "mobile_phone",
+    "merchant_address",
+    "merchant_city",
+    "merchant_state",
+    "ach_trans_type",
+    "ach_statement_id",
+])
+
 class MSSQLDatabase:
     """Async MSSQL Database connection handler for Azure Functions"""
 
-    def __init__(self):
+    # {key} is filled once per worker (see _load_transaction_id_type) and then
+    # kept textually constant: every lookup runs as the same parameterized
+    # query, so SQL Server's plan cache reuses one plan for all transaction_ids
+    _SELECT_TXN_SQL = """
+    SELECT
+        te.transaction_id,
+        bt.stamp,
+        bt.total_amount,
+        bt.consumer_id,
+        bt.terminal_id,
+        bt.approval_code,
+        c.fname,
+        c.lname,
+        c.address1,
+        c.address2,
+        c.city,
+        c.state,
+        c.zip,
+        c.home_phone,
+        c.mobile_phone,
+        m.address1 as merchant_address,
+        m.city as merchant_city,
+        m.state as merchant_state,
+        m.ach_trans_type,
+        m.ach_statement_id
+    FROM bim_transaction bt
+    INNER JOIN bim_consumer c ON bt.consumer_id = c.consumer_id
+    INNER JOIN bim_merchant m ON bt.merchant_id = m.merchant_id
+    LEFT JOIN bim_transaction_events te ON bt.transaction_id = te.transaction_id
+    WHERE bt.transaction_id = {key}
+    """
+
+    _TXN_ID_COLUMN_SQL = """
+    SELECT DATA_TYPE, CHARACTER_MAXIMUM_LENGTH
+    FROM INFORMATION_SCHEMA.COLUMNS
+    WHERE TABLE_SCHEMA = OBJECT_SCHEMA_NAME(OBJECT_ID('bim_transaction'))
+      AND TABLE_NAME = 'bim_transaction'
+      AND COLUMN_NAME = 'transaction_id'
+    """
+
+    _INSERT_EVENT_SQL = """
+    INSERT INTO bim_transaction_events
+    (transaction_id, settled_stamp, settled_log_id, created_by, payliance_auth_id, created_on)
+    VALUES (?, SYSUTCDATETIME(), ?, ?, ?, SYSUTCDATETIME())
+    """
+
+    def __init__(self, cache_size: int = 2048, cache_ttl: float = 60):
         self.connection_pool: Optional[aioodbc.Pool] = None
         self.connection_string = self._build_connection_string()
+        # Recently fetched rows of transactions already sent to Payliance
+        self._transaction_cache: TTLCache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        # Lookup key binding and length limit, from the real column type once the pool is up
+        self._select_txn_sql = self._SELECT_TXN_SQL.format(key="?")
+        self._transaction_id_max_length: Optional[int] = None
+
+    def invalidate(self, transaction_id: str):
+        """Drop a cached transaction row so the next lookup hits the database"""
+        self._transaction_cache.pop(transaction_id, None)
 
     def _build_connection_string(self) -> str:
         """Build MSSQL connection string from environment variables"""
@@ -51,8 +136,11 @@ class MSSQLDatabase:
         logger.info(f"MSSQL connection string built for server: {server}, database: {database}")
         return conn_str
 
-    async def initialize_pool(self, min_size: int = 1, max_size: int = 5):
-        """Initialize connection pool"""
+    async def initialize_pool(self, min_size: int = 1, max_size: int = 5, probe: bool = False):
+        """
+        Initialize connection pool.
+        With probe=True, also round-trip a test query before returning.
+        """
         if not self.connection_string:
             logger.error("Cannot initialize pool - connection string is empty")
             return False
@@ -66,6 +154,11 @@ class MSSQLDatabase:
             )
             logger.info(f"MSSQL connection pool initialized (min: {min_size}, max: {max_size})")
 
+            await self._load_transaction_id_type()
+
+            if not probe:
+                return True
+
             # Test connection
             test_result = await self.test_connection()
             return test_result
@@ -84,6 +177,36 @@ class MSSQLDatabase:
             except Exception as e:
                 logger.error(f"Error closing connection pool: {str(e)}")
 
+    async def _load_transaction_id_type(self):
+        """
+        Bind the lookup key to the actual type of bim_transaction.transaction_id.
+        pyodbc binds str parameters as NVARCHAR; against a VARCHAR/CHAR column
+        that converts every row instead of seeking the index, so the key is cast
+        to the column's own type and length. Keys longer than the column are
+        rejected before querying, so the cast can never truncate one.
+        """
+        try:
+            async with self.connection_pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(self._TXN_ID_COLUMN_SQL)
+                    row = await cursor.fetchone()
+        except Exception as e:
+            logger.warning(f"Could not read bim_transaction.transaction_id type, binding key as NVARCHAR: {str(e)}")
+            return
+
+        if not row:
+            logger.warning("bim_transaction.transaction_id not found in INFORMATION_SCHEMA, binding key as NVARCHAR")
+            return
+
+        data_type, max_length = row[0].lower(), row[1]
+        if max_length is not None and max_length > 0:
+            self._transaction_id_max_length = max_length
+        if data_type in ("varchar", "char") and max_length is not None:
+            width = "MAX" if max_length == -1 else max_length
+            self._select_txn_sql = self._SELECT_TXN_SQL.format(key=f"CAST(? AS {data_type.upper()}({width}))")
+
+        logger.info(f"bim_transaction.transaction_id is {data_type}({max_length})")
+
     async def test_connection(self) -> bool:
         """Test database connection"""
         if not self.connection_pool:
@@ -100,100 +223,97 @@ class MSSQLDatabase:
             logger.error(f"MSSQL connection test failed: {str(e)}")
             return False
 
-    async def get_transaction_by_id(self, transaction_id: str) -> Optional[Dict[str, Any]]:
-        """Get transaction from bim_transaction table by ID"""
-        if not self.connection_pool:
-            logger.warning("Database connection pool not available")
-            return None
+    async def get_transaction_by_id(self, transaction_id: str, conn=None) -> Optional[TxnRow]:
+        """
+        Get transaction from bim_transaction table by ID.
+        Uses the given connection if provided, otherwise acquires one from the pool.
+        Returns None only when no row matches; a failed query raises, so callers
+        can retry instead of treating the transaction as missing.
 
-        query = """
-        SELECT
-            te.transaction_id,
-            right(bt.transaction_id, 6) as serial_number,
-            bt.stamp,
-            bt.total_amount,
-            bt.consumer_id,
-            bt.merchant_id,
-            bt.terminal_id,
-            bt.approval_code,
-            bt.cdf1,
-            bt.cdf2,
-            c.fname,
-            c.lname,
-            c.address1,
-            c.address2,
-            c.city,
-            c.state,
-            c.zip,
-            c.home_phone,
-            c.mobile_phone,
-            m.address1 as merchant_address,
-            m.city as merchant_city,
-            m.state as merchant_state,
-            m.ach_trans_type,
-            m.ach_statement_id,
-            te.settled_log_id
-        FROM bim_transaction bt
-        INNER JOIN bim_consumer c ON bt.consumer_id = c.consumer_id
-        INNER JOIN bim_merchant m ON bt.merchant_id = m.merchant_id
-        LEFT JOIN bim_transaction_events te ON bt.transaction_id = te.transaction_id
-        WHERE bt.transaction_id = ?
+        Only rows that already have a transaction event are cached: that state
+        cannot revert, while an unsent row may be sent by another instance at
+        any time and must always be read fresh.
         """
+        cached = self._transaction_cache.get(transaction_id)
+        if cached is not None:
+            logger.debug(f"Found cached transaction data for ID: {transaction_id}")
+            return cached
+
+        # No row can match a key longer than the column
+        max_length = self._transaction_id_max_length
+        if max_length is not None and len(str(transaction_id)) > max_length:
+            logger.warning(f"Transaction ID {transaction_id} is longer than bim_transaction.transaction_id ({max_length})")
+            return None
+
+        if conn is None:
+            if not self.connection_pool:
+                raise RuntimeError("Database connection pool not available")
 
-        try:
             async with self.connection_pool.acquire() as conn:
-                async with conn.cursor() as cursor:
-                    await cursor.execute(query, (transaction_id,))
-                    row = await cursor.fetchone()
+                return await self.get_transaction_by_id(transaction_id, conn)
+
+        try:
+            async with conn.cursor() as cursor:
+                await cursor.execute(self._select_txn_sql, transaction_id)
+                row = await cursor.fetchone()
 
-                    if row:
-                        # Convert row to dictionary
-                        columns = [column[0] for column in cursor.description]
-                        transaction_data = dict(zip(columns, row))
+                if row:
+                    transaction_data = TxnRow._make(row)
+                    if transaction_data.transaction_id:
+                        self._transaction_cache[transaction_id] = transaction_data
 
-                        logger.info(f"Found transaction data for ID: {transaction_id}")
-                        return transaction_data
-                    else:
-                        logger.warning(f"No transaction found for ID: {transaction_id}")
-                        return None
+                    logger.debug(f"Found transaction data for ID: {transaction_id}")
+                    return transaction_data
+                else:
+                    logger.warning(f"No transaction found for ID: {transaction_id}")
+                    return None
 
         except Exception as e:
             logger.error(f"Database query failed for transaction {transaction_id}: {str(e)}")
-            return None
+            raise
 
 
     async def insert_transaction_event(self,
         transaction_id: str,
         settled_log_id: str,
         created_by: int,
-        payliance_auth_id: str
+        payliance_auth_id: str,
+        conn=None
     ) -> bool:
-        """Insert a record into bim_transaction_events table"""
-        if not self.connection_pool:
-            logger.warning("Database connection pool not available")
-            return False
-
-        query = """
-        INSERT INTO bim_transaction_events
-        (transaction_id, settled_stamp, settled_log_id, created_by, payliance_auth_id, created_on)
-        VALUES (?, GETUTCDATE(), ?, ?, ?, GETUTCDATE())
         """
+        Insert a record into bim_transaction_events table.
+        Uses the given connection if provided, otherwise acquires one from the pool.
+        """
+        if conn is None:
+            if not self.connection_pool:
+                logger.warning("Database connection pool not available")
+                return False
+
+            try:
+                async with self.connection_pool.acquire() as conn:
+                    return await self.insert_transaction_event(
+                        transaction_id, settled_log_id, created_by, payliance_auth_id, conn
+                    )
+            except Exception as e:
+                logger.error(f"Failed to insert transaction event for transaction_id {transaction_id}: {str(e)}")
+                return False
 
         try:
-            async with self.connection_pool.acquire() as conn:
-                async with conn.cursor() as cursor:
-                    await cursor.execute(query, (
-                        transaction_id,
-                        settled_log_id,
-                        created_by,
-                        payliance_auth_id
-                    ))
-                    if cursor.rowcount > 0:
-                        logger.info(f"Inserted transaction event for transaction_id {transaction_id}")
-                        return True
-                    else:
-                        logger.warning(f"No rows inserted for transaction_id {transaction_id}")
-                        return False
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    self._INSERT_EVENT_SQL,
+                    transaction_id,
+                    settled_log_id,
+                    created_by,
+                    payliance_auth_id
+                )
+                if cursor.rowcount > 0:
+                    self.invalidate(transaction_id)
+                    logger.info(f"Inserted transaction event for transaction_id {transaction_id}")
+                    return True
+                else:
+                    logger.warning(f"No rows inserted for transaction_id {transaction_id}")
+                    return False
         except Exception as e:
             logger.error(f"Failed to insert transaction event for transaction_id {transaction_id}: {str(e)}")
             return False
@@ -1,14 +1,20 @@
 import azure.functions as func
-import json
+import azurefunctions.extensions.bindings.servicebus as servicebus
 import logging
 import httpx
+import orjson
 import os
-from datetime import datetime
-from typing import Optional, Dict, Any
+import re
+import sys
+import time
+from datetime import datetime, timezone
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Mapping, Tuple
 import uuid
 from database import db
 from dotenv import load_dotenv
 import asyncio
+from cachetools import TTLCache
 from enum import Enum
 
 class ErrorType(Enum):
@@ -36,6 +42,238 @@ logger = logging.getLogger(__name__)
 SERVICE_BUS_CONNECTION = "ServiceBusConnection"
 SERVICE_BUS_QUEUE = os.environ.get("SERVICE_BUS_QUEUE")
 
+# Payliance API configuration, read once per worker
+PAYLIANCE_BASE_URL = os.environ.get("PAYLIANCE_BASE_URL")
+PAYLIANCE_AUTH_TOKEN = os.environ.get("PAYLIANCE_AUTH_TOKEN")
+_AUTH_HEADER = f"Bearer {PAYLIANCE_AUTH_TOKEN}" if PAYLIANCE_AUTH_TOKEN else None
+_DEBIT_URL = f"{PAYLIANCE_BASE_URL}/api/v1/echeck/debit" if PAYLIANCE_BASE_URL else None
+# Constant Payliance headers; httpx accepts a list of pairs, so each request
+# only appends its X-Request-ID instead of building a dict
+_PAYLIANCE_HEADERS_BASE = (
+    ('accept', 'text/plain'),
+    ('Authorization', _AUTH_HEADER),
+    ('Content-Type', 'application/json'),
+)
+
+logger.info("PAYLIANCE_BASE_URL: %s", PAYLIANCE_BASE_URL)
+logger.info("PAYLIANCE_AUTH_TOKEN configured: %s", bool(PAYLIANCE_AUTH_TOKEN))
+
+# datetime.fromisoformat() only accepts a trailing 'Z' from Python 3.11
+_FROMISOFORMAT_ACCEPTS_Z = sys.version_info >= (3, 11)
+
+# Payliance debit fields that are the same for every transaction (read-only)
+_PAYLIANCE_PAYLOAD_TEMPLATE: Mapping[str, Any] = MappingProxyType({
+    "routing": "121000358",
+    "accountNumber": "5428610017522",
+    # Additional fields that may be required by Payliance API
+    "posCardTransactionTypeCode": "01",
+    "posReferenceInfo2": "00",
+    "accountType": "Personal Checking",
+    "isSameDay": False,
+    "futureDate": "",
+    "microEntry": False,
+    "convenienceFee": False,
+    "convenienceFeeAmount": 0
+})
+
+# Database pool sizing, tunable per deployment/plan instance count
+DB_POOL_MIN_SIZE = int(os.environ.get("MSSQL_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.environ.get("MSSQL_POOL_MAX_SIZE", "10"))
+
+# Shared HTTP client so TCP/TLS connections are reused across invocations
+_client: Optional[httpx.AsyncClient] = None
+_client_loop_id: Optional[int] = None
+_payliance_warmed = False
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Return the shared Payliance HTTP client for the running event loop.
+
+    HTTP/2 lets concurrent debits multiplex over one TLS connection (httpx
+    falls back to HTTP/1.1 if the server does not negotiate h2 via ALPN).
+    Pooled connections belong to the loop that opened them, so the client
+    is rebuilt if the worker ever runs on a different loop.
+    """
+    global _client, _client_loop_id, _payliance_warmed
+    loop_id = id(asyncio.get_running_loop())
+    if _client is None or _client_loop_id != loop_id:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout=30.0, connect=10.0),
+            verify=True,
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0)
+        )
+        _client_loop_id = loop_id
+        _payliance_warmed = False
+    return _client
+
+# Record transaction events after responding instead of before (eventually consistent)
+ASYNC_EVENT_INSERT = os.environ.get("ASYNC_EVENT_INSERT", "false").lower() == "true"
+# Strong references to in-flight background tasks so they are not garbage collected
+_background_tasks: set = set()
+
+async def _run_to_completion(coro):
+    """
+    Await a coroutine that must not be abandoned halfway.
+    If the caller is cancelled (host shutdown, function timeout, client
+    disconnect) the coroutine keeps running, so a debit that reached
+    Payliance is still recorded as sent.
+    """
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return await asyncio.shield(task)
+
+# Service Bus messages that completed successfully on this worker, keyed by
+# message ID (or transaction ID), so redeliveries after a lost ack skip Payliance
+_processed_messages: TTLCache = TTLCache(maxsize=10000, ttl=900)
+
+# Guards one-time pool creation per worker
+_db_init_lock = asyncio.Lock()
+
+async def _ensure_pool(probe: bool = False) -> bool:
+    """
+    Initialize the database connection pool once per worker.
+
+    Returns immediately when the pool is already warm; otherwise concurrent
+    callers wait on a lock so only one of them creates the pool. The
+    SELECT 1 probe only runs when requested (warmup), never on a request.
+    """
+    if db.connection_pool:
+        return True
+
+    async with _db_init_lock:
+        if db.connection_pool:
+            return True
+
+        logger.info("Initializing database connection pool (min: %s, max: %s)...", DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE)
+        db_initialized = await db.initialize_pool(min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, probe=probe)
+        if not db_initialized:
+            logger.warning("Database initialization failed")
+        return db_initialized
+
+def _elapsed_ms(start_ns: int) -> float:
+    """Milliseconds elapsed since a time.perf_counter_ns() reading"""
+    return (time.perf_counter_ns() - start_ns) / 1_000_000
+
+def _json_response(payload: Any, status_code: int) -> func.HttpResponse:
+    """Build a JSON HttpResponse; orjson's bytes are passed through without re-encoding"""
+    return func.HttpResponse(
+        body=orjson.dumps(payload),
+        status_code=status_code,
+        mimetype="application/json"
+    )
+
+def _log_debit_summary(request_id: str, transaction_id: Optional[str], result: Dict[str, Any], processing_time: float):
+    """
+    Log the single summary record for a debit request.
+    The fields are also attached as structured extras for log ingestion.
+    """
+    error_type = result.get("error_type")
+    fields = {
+        "request_id": request_id,
+        "transaction_id": transaction_id,
+        "status_code": result["status_code"],
+        "success": result["success"],
+        "error_type": error_type.value if error_type else None,
+        "processing_time_ms": processing_time,
+    }
+    logger.log(
+        logging.INFO if result["success"] else logging.WARNING,
+        "[%s] debit_request transaction=%s status=%s error_type=%s in %.2fms",
+        request_id, transaction_id, fields["status_code"], fields["error_type"], processing_time,
+        extra=fields
+    )
+
+def _error_result(status_code: int, error: str, request_id: str,
+                  error_type: Optional[ErrorType] = None) -> Dict[str, Any]:
+    """
+    Build the process_debit() result for a debit rejected before the Payliance call.
+    The error type is derived from classify_error() unless given.
+    """
+    return {
+        "success": False,
+        "status_code": status_code,
+        "error_type": error_type or classify_error(Exception(error), status_code),
+        "body": {
+            "success": False,
+            "error": error,
+            "request_id": request_id
+        }
+    }
+
+# Debit error results by exception class: (log label, status code, message, error type).
+# A None status code or error type is derived from classify_error().
+_ERROR_RESPONSES = {
+    httpx.TimeoutException: ("TIMEOUT ERROR", 408, "Request timeout - Payliance API did not respond within 30 seconds", ErrorType.TRANSIENT),
+    asyncio.TimeoutError: ("TIMEOUT ERROR", 408, "Request timeout - Payliance API did not respond within 30 seconds", ErrorType.TRANSIENT),
+    httpx.HTTPStatusError: ("HTTP ERROR", None, "HTTP error from Payliance API: {}", None),
+    httpx.NetworkError: ("NETWORK ERROR", 503, "Network error connecting to Payliance API: {}", ErrorType.TRANSIENT),
+    httpx.RequestError: ("REQUEST ERROR", None, "Failed to call Payliance API: {}", None),
+    Exception: ("UNEXPECTED ERROR", None, "Unexpected error: {}", None),
+}
+
+def _error_result_for(e: Exception, transaction_id: Optional[str], request_id: str, processing_time: float) -> Dict[str, Any]:
+    """
+    Build the process_debit() result for an exception.
+    Walks the exception's MRO so subclasses (e.g. ConnectTimeout) resolve to
+    their closest entry in _ERROR_RESPONSES.
+    """
+    for cls in type(e).__mro__:
+        entry = _ERROR_RESPONSES.get(cls)
+        if entry is not None:
+            break
+    label, status_code, message, error_type = entry
+
+    response_status = getattr(getattr(e, 'response', None), 'status_code', None)
+    if error_type is None:
+        error_type = classify_error(e, response_status)
+    if status_code is None:
+        status_code = response_status or (500 if error_type is ErrorType.TRANSIENT else 400)
+    et_value = error_type.value
+
+    logger.error("[%s] %s (%s) for transaction %s: %s", request_id, label, et_value, transaction_id, e)
+
+    return {
+        "success": False,
+        "status_code": status_code,
+        "error_type": error_type,
+        "body": {
+            "success": False,
+            "error": message.format(e),
+            "error_type": et_value,
+            "transaction_id": transaction_id,
+            "request_id": request_id,
+            "processing_time_ms": processing_time
+        }
+    }
+
+# HTTP status codes with a known error type; other codes fall through to message matching.
+# Server errors (5xx), Too Many Requests (429) and Not Found (404) are transient,
+# client errors that indicate permanent issues are permanent.
+_STATUS_MAP: Dict[int, ErrorType] = {code: ErrorType.TRANSIENT for code in range(500, 600)}
+_STATUS_MAP[429] = ErrorType.TRANSIENT
+_STATUS_MAP[404] = ErrorType.TRANSIENT
+_STATUS_MAP.update((code, ErrorType.PERMANENT) for code in (400, 401, 403, 405, 409, 422))
+
+# Exact exception types that are always transient; subclasses not listed here
+# fall back to the isinstance checks in classify_error()
+_EXACT_ERROR_TYPES: Dict[type, ErrorType] = {
+    cls: ErrorType.TRANSIENT for cls in (
+        httpx.TimeoutException, httpx.ConnectTimeout, httpx.ReadTimeout,
+        httpx.WriteTimeout, httpx.PoolTimeout, asyncio.TimeoutError,
+        httpx.NetworkError, httpx.ConnectError, httpx.ReadError,
+        httpx.WriteError, httpx.CloseError,
+    )
+}
+
+# Error messages that indicate permanent issues
+_PERMANENT_RE = re.compile(
+    r"unauthorized|forbidden|authentication|invalid token|bad request|malformed"
+    r"|invalid data|validation failed|not found|conflict|duplicate|already exists",
+    re.IGNORECASE
+)
+
 def classify_error(exception: Exception, status_code: int = None) -> ErrorType:
     """
     Classify errors into transient or permanent types for retry logic.
@@ -45,15 +283,21 @@ def classify_error(exception: Exception, status_code: int = None) -> ErrorType:
     - Connection errors
     - Temporary server errors (5xx)
     - Service unavailable
+    - Too many requests (429)
+    - Resource not found (404)
 
     Permanent Errors (should not retry):
     - Authentication errors (401, 403)
     - Bad request/data validation errors (400)
-    - Resource not found (404)
     - Method not allowed (405)
     - Conflict (409)
     - Unprocessable entity (422)
     """
+    # Common timeout/network exception types - one lookup
+    error_type = _EXACT_ERROR_TYPES.get(type(exception))
+    if error_type is not None:
+        return error_type
+
     # Check for timeout exceptions - always transient
     if isinstance(exception, (httpx.TimeoutException, asyncio.TimeoutError)):
         return ErrorType.TRANSIENT
@@ -63,650 +307,427 @@ def classify_error(exception: Exception, status_code: int = None) -> ErrorType:
         return ErrorType.TRANSIENT
 
     # Check HTTP status codes
-    if status_code:
-        # Server errors (5xx) - transient
-        if 500 <= status_code < 600:
-            return ErrorType.TRANSIENT
-
-        # Too Many Requests (429) - transient
-        if status_code == 429:
-            return ErrorType.TRANSIENT
-
-        # Not Found (404) - transient
-        if status_code == 404:
-            return ErrorType.TRANSIENT
-
-        # Client errors that indicate permanent issues
-        permanent_status_codes = {400, 401, 403, 405, 409, 422}
-        if status_code in permanent_status_codes:
-            return ErrorType.PERMANENT
+    if status_code is not None:
+        error_type = _STATUS_MAP.get(status_code)
+        if error_type is not None:
+            return error_type
 
     # Check for specific error messages that indicate permanent issues
-    error_message = str(exception).lower()
-    permanent_keywords = [
-        'unauthorized', 'forbidden', 'authentication', 'invalid token',
-        'bad request', 'malformed', 'invalid data', 'validation failed',
-        'not found', 'conflict', 'duplicate', 'already exists'
-    ]
-
-    for keyword in permanent_keywords:
-        if keyword in error_message:
-            return ErrorType.PERMANENT
+    if _PERMANENT_RE.search(str(exception)):
+        return ErrorType.PERMANENT
 
     # Default to transient for unknown errors to allow retry
     return ErrorType.TRANSIENT
 
+@app.function_name(name="warmup")
+@app.warm_up_trigger("warmup")
+async def warmup(warmup) -> None:
+    """Create and probe the database pool before the instance starts receiving traffic"""
+    await _ensure_pool(probe=True)
+
 @app.function_name(name="health")
 @app.route(route="health", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
 async def health_check(req: func.HttpRequest) -> func.HttpResponse:
-    return func.HttpResponse(
-        json.dumps({"status": "healthy"}),
-        status_code=200,
-        mimetype="application/json"
-    )
+    return _json_response({"status": "healthy"}, 200)
 
 @app.function_name(name="ServiceBusDebitProcessor")
 @app.service_bus_queue_trigger(
-    arg_name="msg",
+    arg_name="msgs",
     queue_name=SERVICE_BUS_QUEUE,
-    connection=SERVICE_BUS_CONNECTION
+    connection=SERVICE_BUS_CONNECTION,
+    cardinality="many",
+    auto_complete_messages=False
 )
-async def service_bus_debit_processor(msg: func.ServiceBusMessage) -> None:
+async def service_bus_debit_processor(msgs: List[servicebus.ServiceBusReceivedMessage],
+                                      message_actions: servicebus.ServiceBusMessageActions) -> None:
     """
-    Azure Function triggered by Service Bus messages to process debit transactions.
-    Each message from the Service Bus will trigger a call to the /debit endpoint.
+    Azure Function triggered by batches of Service Bus messages to process debit transactions.
+    Messages in a batch are processed concurrently through process_debit() and
+    settled individually.
 
     Error Handling:
-    - Transient errors: Allow Service Bus retry (raise exception)
-    - Permanent errors: Acknowledge message to prevent retry
+    - Success: Complete the message
+    - Transient errors: Abandon the message so Service Bus redelivers it
+      (and dead-letters it after the queue's max delivery count)
+    - Permanent errors: Dead-letter the message with the reason, without retry
+    """
+    results = await asyncio.gather(*(_process_message(msg) for msg in msgs), return_exceptions=True)
+
+    # The settlement calls are blocking gRPC stubs; run them on the default
+    # executor so they do not stall other invocations on the event loop
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(
+        loop.run_in_executor(None, _settle_message, message_actions, msg, outcome)
+        for msg, outcome in zip(msgs, results)
+    ))
+
+def _settle_message(message_actions: servicebus.ServiceBusMessageActions,
+                    msg: servicebus.ServiceBusReceivedMessage, outcome: Any) -> None:
+    """Complete, dead-letter or abandon one message based on its _process_message() outcome"""
+    try:
+        if isinstance(outcome, BaseException):
+            message_actions.abandon(msg)
+        elif outcome is not None:
+            reason, description = outcome
+            message_actions.deadletter(msg, deadletter_reason=reason, deadletter_error_description=description)
+        else:
+            message_actions.complete(msg)
+    except Exception as e:
+        # The lock expires and Service Bus redelivers the message
+        logger.error("Failed to settle Service Bus message %s: %s", getattr(msg, 'message_id', None), e)
+
+def _message_body(msg: servicebus.ServiceBusReceivedMessage) -> bytes:
+    """Return the message body as bytes (data bodies arrive as a sequence of sections)"""
+    body = msg.body
+    if isinstance(body, (bytes, bytearray)):
+        return bytes(body)
+    return b"".join(body)
+
+async def _process_message(msg: servicebus.ServiceBusReceivedMessage) -> Optional[Tuple[str, str]]:
+    """
+    Process one Service Bus message.
+    Returns None on success, (dead-letter reason, description) for permanent
+    errors, and raises for transient errors.
     """
-    message_id = str(uuid.uuid4())
-    start_time = datetime.now()
+    message_id = uuid.uuid4().hex
+    start_ns = time.perf_counter_ns()
     delivery_count = getattr(msg, 'delivery_count', 1)
 
     try:
         # Get message content
-        message_body = msg.get_body().decode('utf-8')
-        logger.info(f"[{message_id}] Received Service Bus message (delivery #{delivery_count}): {message_body}")
+        body_bytes = _message_body(msg)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[%s] Received Service Bus message (delivery #%s): %s",
+                         message_id, delivery_count, body_bytes.decode('utf-8', errors='replace'))
 
         # Parse the message body as JSON
         try:
-            message_data = json.loads(message_body)
-        except json.JSONDecodeError as e:
-            logger.error(f"[{message_id}] Failed to parse message as JSON: {str(e)}")
-            logger.error(f"[{message_id}] Raw message: {message_body}")
-            # JSON parsing error is permanent - acknowledge message to prevent retry
-            logger.error(f"[{message_id}] PERMANENT ERROR: Invalid JSON format - acknowledging message")
-            return  # Return without raising to acknowledge message
+            message_data = orjson.loads(body_bytes)
+        except orjson.JSONDecodeError as e:
+            # JSON parsing error is permanent - dead-letter message to prevent retry
+            logger.error("[%s] PERMANENT ERROR: Invalid JSON format (%s) - dead-lettering message: %s",
+                         message_id, e, body_bytes.decode('utf-8', errors='replace'))
+            return "InvalidJson", str(e)
+
+        if not isinstance(message_data, dict):
+            logger.error("[%s] PERMANENT ERROR: Message body is not a JSON object - dead-lettering message: %s",
+                         message_id, body_bytes.decode('utf-8', errors='replace'))
+            return "InvalidJson", "Message body is not a JSON object"
 
         # Extract transaction_id from the message
         transaction_id = message_data.get('transaction_id')
         if not transaction_id:
-            logger.error(f"[{message_id}] No transaction_id found in message")
-            logger.error(f"[{message_id}] Message data: {message_data}")
-            # Missing transaction_id is permanent - acknowledge message to prevent retry
-            logger.error(f"[{message_id}] PERMANENT ERROR: Missing transaction_id - acknowledging message")
-            return  # Return without raising to acknowledge message
+            # Missing transaction_id is permanent - dead-letter message to prevent retry
+            logger.error("[%s] PERMANENT ERROR: Missing transaction_id - dead-lettering message: %s",
+                         message_id, message_data)
+            return "MissingTransactionId", "No transaction_id found in message"
 
-        logger.info(f"[{message_id}] Processing Service Bus message for transaction: {transaction_id}")
+        idempotency_key = getattr(msg, 'message_id', None) or transaction_id
+        if idempotency_key in _processed_messages:
+            logger.warning("[%s] Transaction %s already processed for message %s - completing duplicate delivery",
+                           message_id, transaction_id, idempotency_key)
+            return None
 
-        # Call the debit endpoint
-        result = await call_debit_endpoint_with_error_handling(transaction_id, message_id)
-
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
-
-        if result['success']:
-            logger.info(f"[{message_id}] Service Bus message processed successfully for transaction {transaction_id} in {processing_time:.2f}ms")
-        else:
-            # Check error type from the result
-            error_type = result.get('error_type', ErrorType.TRANSIENT)
-            error_message = result.get('error_message', 'Unknown error')
-
-            logger.error(f"[{message_id}] Failed to process Service Bus message for transaction {transaction_id} in {processing_time:.2f}ms")
-            logger.error(f"[{message_id}] Error type: {error_type.value}, Message: {error_message}")
-
-            if error_type == ErrorType.PERMANENT:
-                logger.error(f"[{message_id}] PERMANENT ERROR detected - acknowledging message to prevent retry")
-                return  # Return without raising to acknowledge message
-            else:
-                logger.error(f"[{message_id}] TRANSIENT ERROR detected - allowing Service Bus retry")
-                raise DebitError(f"Transient error processing debit transaction {transaction_id}: {error_message}", ErrorType.TRANSIENT)
-
-    except DebitError as e:
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
-        logger.error(f"[{message_id}] Debit error processing Service Bus message: {str(e)}")
-        logger.error(f"[{message_id}] Processing time: {processing_time:.2f}ms")
-        logger.error(f"[{message_id}] Error type: {e.error_type.value}")
-
-        # Log message properties for debugging
-        try:
-            logger.error(f"[{message_id}] Message ID: {msg.message_id}")
-            logger.error(f"[{message_id}] Delivery count: {delivery_count}")
-            logger.error(f"[{message_id}] Enqueued time: {msg.enqueued_time_utc}")
-        except Exception as prop_error:
-            logger.error(f"[{message_id}] Error logging message properties: {str(prop_error)}")
-
-        # Handle based on error type
-        if e.error_type == ErrorType.PERMANENT:
-            logger.error(f"[{message_id}] PERMANENT ERROR - acknowledging message to prevent retry")
-            return  # Return without raising to acknowledge message
-        else:
-            logger.error(f"[{message_id}] TRANSIENT ERROR - allowing Service Bus retry")
-            raise  # Re-raise to trigger Service Bus retry mechanism
+        # Process the debit in-process (no HTTP hop to our own /debit endpoint)
+        result = await _run_to_completion(process_debit(transaction_id, message_id))
 
     except Exception as e:
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
-        logger.error(f"[{message_id}] Unexpected error processing Service Bus message: {str(e)}")
-        logger.error(f"[{message_id}] Processing time: {processing_time:.2f}ms")
-
-        # Log message properties for debugging
-        try:
-            logger.error(f"[{message_id}] Message ID: {msg.message_id}")
-            logger.error(f"[{message_id}] Delivery count: {delivery_count}")
-            logger.error(f"[{message_id}] Enqueued time: {msg.enqueued_time_utc}")
-        except Exception as prop_error:
-            logger.error(f"[{message_id}] Error logging message properties: {str(prop_error)}")
-
         # Classify unknown errors and handle accordingly
         error_type = classify_error(e)
-        logger.error(f"[{message_id}] Classified as: {error_type.value}")
-
-        if error_type == ErrorType.PERMANENT:
-            logger.error(f"[{message_id}] PERMANENT ERROR - acknowledging message to prevent retry")
-            return  # Return without raising to acknowledge message
-        else:
-            logger.error(f"[{message_id}] TRANSIENT ERROR - allowing Service Bus retry")
-            raise  # Re-raise to trigger Service Bus retry mechanism
-
-async def call_debit_endpoint_with_error_handling(transaction_id: str, correlation_id: str = None) -> Dict[str, Any]:
+        logger.error("[%s] Unexpected %s error processing Service Bus message in %.2fms "
+                     "(message ID: %s, delivery count: %s, enqueued: %s): %s",
+                     message_id, error_type.value, _elapsed_ms(start_ns), getattr(msg, 'message_id', None),
+                     delivery_count, getattr(msg, 'enqueued_time_utc', None), e)
+
+        if error_type is ErrorType.PERMANENT:
+            return "PermanentError", str(e)
+        raise  # Re-raise so the message is abandoned and redelivered
+
+    # The summary record is the only log line for a processed debit
+    _log_debit_summary(message_id, transaction_id, result, _elapsed_ms(start_ns))
+
+    if result['success'] or result.get('already_sent'):
+        # A redelivery of a debit that was sent before (e.g. by a cancelled
+        # invocation or another instance) is complete, not a failure
+        _processed_messages[idempotency_key] = result['status_code']
+        return None
+
+    error_message = result['body'].get('error', 'Unknown error')
+    if result.get('error_type', ErrorType.TRANSIENT) is ErrorType.PERMANENT:
+        return "PermanentDebitError", error_message
+    # Raised to the batch trigger, which abandons the message for redelivery
+    raise DebitError(f"Transient error processing debit transaction {transaction_id}: {error_message}", ErrorType.TRANSIENT)
+
+async def _record_transaction_event(transaction_id: str, authorization_id: str, request_id: str) -> bool:
     """
-    Helper function to call the debit endpoint internally with proper error classification.
-
-    Args:
-        transaction_id: The transaction ID to process
-        correlation_id: Optional correlation ID for logging
-
-    Returns:
-        Dict containing success status, error_type, and error_message
+    Insert the transaction event for a successful debit.
+    Errors are logged and never raised, so it is safe to run as a background task.
     """
-    if not correlation_id:
-        correlation_id = str(uuid.uuid4())
-
     try:
-        # Get environment variables for internal call
-        function_app_url = os.environ.get('FUNCTION_APP_URL', 'http://localhost:7071')
-        function_key = os.environ.get('FUNCTION_KEY', '')
-
-        # Prepare the request payload
-        payload = {"transaction_id": transaction_id}
-
-        # Prepare headers
-        headers = {
-            'Content-Type': 'application/json',
-            'X-Correlation-ID': correlation_id
-        }
-
-        # Add function key if available (for production)
-        if function_key:
-            headers['x-functions-key'] = function_key
-
-        # Construct the URL - FIXED: Changed from debit1 to debit
-        debit_url = f"{function_app_url}/api/debit"
-
-        logger.info(f"[{correlation_id}] Calling debit endpoint: {debit_url}")
-        logger.info(f"[{correlation_id}] Request payload: {payload}")
-        logger.info(f"[{correlation_id}] Request headers: {headers}")
+        insert_success = await db.insert_transaction_event(
+            transaction_id=transaction_id,
+            settled_log_id=datetime.now().strftime('%y%m%d%H'),
+            created_by=9998,
+            payliance_auth_id=authorization_id
+        )
 
-        # Make the HTTP call with timeout and retry logic
-        timeout = httpx.Timeout(timeout=60.0, connect=10.0)
-        async with httpx.AsyncClient(timeout=timeout, verify=True) as client:  # CHANGED: verify=True to catch SSL errors
-            logger.info(f"[{correlation_id}] Making POST request to {debit_url}")
-            response = await client.post(debit_url, headers=headers, json=payload)
-            logger.info(f"[{correlation_id}] Received response with status code: {response.status_code}")
+        if insert_success:
+            logger.info("[%s] Record inserted with AuthorizationId: %s in events", request_id, authorization_id)
+        return insert_success
+    except Exception as e:
+        logger.error("[%s] Error inserting record in database: %s", request_id, e)
+        return False
 
-        if response.status_code == 200:
-            logger.info(f"[{correlation_id}] Debit endpoint call successful for transaction {transaction_id}")
-            try:
-                response_data = response.json()
-                if response_data.get('success'):
-                    return {"success": True}
-                else:
-                    error_msg = f"Debit endpoint returned success=false: {response_data}"
-                    logger.warning(f"[{correlation_id}] {error_msg}")
-                    # Classify based on response content
-                    error_type = classify_error(Exception(error_msg), response.status_code)
-                    return {
-                        "success": False,
-                        "error_type": error_type,
-                        "error_message": error_msg
-                    }
-            except json.JSONDecodeError:
-                logger.warning(f"[{correlation_id}] Could not parse debit endpoint response as JSON")
-                return {"success": True}  # Assume success if we got 200 but couldn't parse
-        else:
-            error_msg = f"Debit endpoint call failed with status {response.status_code}: {response.text}"
-            logger.error(f"[{correlation_id}] {error_msg}")
-            error_type = classify_error(Exception(error_msg), response.status_code)
-            return {
-                "success": False,
-                "error_type": error_type,
-                "error_message": error_msg
-            }
+async def _warm_payliance_connection(base_url: str, request_id: str) -> None:
+    """
+    Open the first TCP/TLS connection to Payliance ahead of the debit POST so the
+    handshake overlaps with the database lookup. Runs once per worker since the
+    shared client keeps the connection alive afterwards. Failures are ignored;
+    the POST simply opens its own connection.
+    """
+    global _payliance_warmed
+    if _payliance_warmed:
+        return
+    _payliance_warmed = True
 
-    except (httpx.TimeoutException, asyncio.TimeoutError) as e:
-        error_msg = f"Timeout calling debit endpoint for transaction {transaction_id}: {str(e)}"
-        logger.error(f"[{correlation_id}] {error_msg}")
-        return {
-            "success": False,
-            "error_type": ErrorType.TRANSIENT,
-            "error_message": error_msg
-        }
-    except (httpx.ConnectError, httpx.NetworkError, httpx.ConnectTimeout) as e:
-        error_msg = f"Network error calling debit endpoint for transaction {transaction_id}: {str(e)}"
-        logger.error(f"[{correlation_id}] {error_msg}")
-        logger.error(f"[{correlation_id}] URL attempted: {debit_url}")
-        logger.error(f"[{correlation_id}] Exception type: {type(e).__name__}")
-        return {
-            "success": False,
-            "error_type": ErrorType.TRANSIENT,
-            "error_message": error_msg
-        }
-    except httpx.RequestError as e:
-        error_msg = f"Request error calling debit endpoint for transaction {transaction_id}: {str(e)}"
-        logger.error(f"[{correlation_id}] {error_msg}")
-        logger.error(f"[{correlation_id}] URL attempted: {debit_url}")
-        logger.error(f"[{correlation_id}] Exception type: {type(e).__name__}")
-        logger.error(f"[{correlation_id}] Exception details: {repr(e)}")
-        error_type = classify_error(e)
-        return {
-            "success": False,
-            "error_type": error_type,
-            "error_message": error_msg
-        }
+    try:
+        await get_client().head(base_url, timeout=5.0)
     except Exception as e:
-        error_msg = f"Unexpected error calling debit endpoint for transaction {transaction_id}: {str(e)}"
-        logger.error(f"[{correlation_id}] {error_msg}")
-        logger.error(f"[{correlation_id}] URL attempted: {debit_url}")
-        logger.error(f"[{correlation_id}] Exception type: {type(e).__name__}")
-        logger.error(f"[{correlation_id}] Exception details: {repr(e)}")
-        error_type = classify_error(e)
-        return {
-            "success": False,
-            "error_type": error_type,
-            "error_message": error_msg
-        }
+        logger.debug("[%s] Payliance connection warm-up failed: %s", request_id, e)
 
-async def call_debit_endpoint(transaction_id: str, correlation_id: str = None) -> bool:
+async def process_debit(transaction_id: str, request_id: str) -> Dict[str, Any]:
     """
-    Helper function to call the debit endpoint internally (backward compatibility).
+    Process a Payliance debit for a transaction. Shared by the HTTP and
+    Service Bus triggers.
 
     Args:
         transaction_id: The transaction ID to process
-        correlation_id: Optional correlation ID for logging
+        request_id: Correlation ID for logging and X-Request-ID
 
     Returns:
-        bool: True if successful, False otherwise
+        Dict containing success, status_code (HTTP status for the caller),
+        error_type (ErrorType, failures only), already_sent (True when the
+        database shows the debit was sent before) and body (the JSON response body)
     """
-    result = await call_debit_endpoint_with_error_handling(transaction_id, correlation_id)
-    return result['success']
-
-@app.function_name(name="PaylianceDebitFunction")
-@app.route(route="debit", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-async def payliance_debit_function(req: func.HttpRequest) -> func.HttpResponse:
-    """
-    Azure Function to process Payliance debit transactions
-
-    Expects JSON body with:
-    {
-        "transaction_id": "string"
-    }
-    """
-
-    request_id = str(uuid.uuid4())
-    start_time = datetime.now()
+    start_ns = time.perf_counter_ns()
 
     try:
-        # Initialize database connection if not already done
-        if not db.connection_pool:
-            logger.info(f"[{request_id}] Initializing database connection...")
-            db_initialized = await db.initialize_pool(min_size=1, max_size=3)
-            if not db_initialized:
-                logger.warning(f"[{request_id}] Database initialization failed")
-
-        # Get request body
-        req_body = req.get_json()
-
-        if not req_body:
-            logger.error(f"[{request_id}] No JSON body provided")
-            return func.HttpResponse(
-                json.dumps({
-                    "success": False,
-                    "error": "No JSON body provided",
-                    "request_id": request_id
-                }),
-                status_code=400,
-                mimetype="application/json"
-            )
+        # Fallback for instances that were not warmed up (e.g. Consumption plan)
+        await _ensure_pool()
 
-        # Extract transaction_id
-        transaction_id = req_body.get('transaction_id')
+        logger.debug("[%s] Processing debit transaction for ID: %s", request_id, transaction_id)
 
-        if not transaction_id:
-            logger.error(f"[{request_id}] transaction_id is required")
-            return func.HttpResponse(
-                json.dumps({
-                    "success": False,
-                    "error": "transaction_id is required",
-                    "request_id": request_id
-                }),
-                status_code=400,
-                mimetype="application/json"
-            )
+        if not _AUTH_HEADER:
+            logger.error("[%s] PAYLIANCE_AUTH_TOKEN not configured", request_id)
+            return _error_result(500, "PAYLIANCE_AUTH_TOKEN not configured", request_id)
 
-        logger.info(f"[{request_id}] Processing debit transaction for ID: {transaction_id}")
-
-        # Get environment variables
-        payliance_base_url = os.environ.get('PAYLIANCE_BASE_URL')
-        auth_token = os.environ.get('PAYLIANCE_AUTH_TOKEN')
-
-        # Debug logging for environment variables
-        logger.info(f"[{request_id}] PAYLIANCE_BASE_URL: {payliance_base_url}")
-        logger.info(f"[{request_id}] PAYLIANCE_AUTH_TOKEN configured: {bool(auth_token)}")
-
-        if not auth_token:
-            logger.error(f"[{request_id}] PAYLIANCE_AUTH_TOKEN not configured")
-            return func.HttpResponse(
-                json.dumps({
-                    "success": False,
-                    "error": "PAYLIANCE_AUTH_TOKEN not configured",
-                    "request_id": request_id
-                }),
-                status_code=500,
-                mimetype="application/json"
-            )
+        if not _DEBIT_URL:
+            logger.error("[%s] PAYLIANCE_BASE_URL not configured", request_id)
+            return _error_result(500, "PAYLIANCE_BASE_URL not configured", request_id)
 
-        if not payliance_base_url:
-            logger.error(f"[{request_id}] PAYLIANCE_BASE_URL not configured")
-            return func.HttpResponse(
-                json.dumps({
-                    "success": False,
-                    "error": "PAYLIANCE_BASE_URL not configured",
-                    "request_id": request_id
-                }),
-                status_code=500,
-                mimetype="application/json"
+        if not db.connection_pool:
+            logger.warning("[%s] Database connection not available", request_id)
+            return _error_result(503, "Database connection not available", request_id)
+
+        # Fetch transaction details from database. The lookup and the event insert
+        # each hold a pooled connection only for their own query, never across
+        # the Payliance call
+        logger.debug("[%s] Fetching transaction details from database for ID: %s", request_id, transaction_id)
+        # Open the Payliance connection while the lookup is in flight
+        try:
+            transaction_data, _ = await asyncio.gather(
+                db.get_transaction_by_id(transaction_id),
+                _warm_payliance_connection(PAYLIANCE_BASE_URL, request_id)
             )
-
-        # Fetch transaction details from database
-        transaction_data = None
-        if db.connection_pool:
+        except Exception as e:
+            # Link failures, timeouts and deadlocks are retryable; only an empty result is a 404
+            raise DebitError(f"Database lookup failed for transaction {transaction_id}: {e}", ErrorType.TRANSIENT, 503) from e
+
+        if transaction_data is None:
+            logger.warning("[%s] Transaction not found in database", request_id)
+            # A 404 from Payliance may be transient, but a missing row will not reappear on retry
+            return _error_result(404, f"Transaction {transaction_id} not found", request_id, ErrorType.PERMANENT)
+
+        if transaction_data.transaction_id:
+            logger.warning("[%s] Transaction already sent to Payliance", request_id)
+            result = _error_result(409, "Transaction already sent to Payliance", request_id)
+            result["already_sent"] = True
+            return result
+
+        logger.debug("[%s] Database lookup successful - found transaction data", request_id)
+
+        # Parse datetime from database
+        stamp = transaction_data.stamp
+        if isinstance(stamp, str):
             try:
-                logger.info(f"[{request_id}] Fetching transaction details from database for ID: {transaction_id}")
-                transaction_data = await db.get_transaction_by_id(transaction_id)
-
-                if transaction_data.get('transaction_id'):
-                    logger.warning(f"[{request_id}] Transaction already sent to Payliance")
-                    return func.HttpResponse(
-                        json.dumps({
-                            "success": False,
-                            "error": "Transaction already sent to Payliance",
-                            "request_id": request_id
-                        }),
-                        status_code=409,
-                        mimetype="application/json"
-                    )
-                elif not transaction_data.get('transaction_id'):
-                    logger.info(f"[{request_id}] Database lookup successful - found transaction data")
-                else:
-                    logger.warning(f"[{request_id}] Transaction not found in database")
-            except Exception as e:
-                logger.error(f"[{request_id}] Database lookup failed: {str(e)}")
-        else:
-            logger.warning(f"[{request_id}] Database connection not available")
-
-        # Use database data if available
-        if not transaction_data.get('transaction_id'):
-            # Parse datetime from database
-            stamp = transaction_data.get('stamp')
-            if isinstance(stamp, str):
-                try:
-                    stamp = datetime.fromisoformat(stamp.replace('Z', '+00:00'))
-                except ValueError:
-                    logger.warning(f"[{request_id}] Invalid datetime format for stamp, using current time")
-                    stamp = datetime.now()
-            elif not stamp:
+                stamp = datetime.fromisoformat(stamp if _FROMISOFORMAT_ACCEPTS_Z else stamp.replace('Z', '+00:00'))
+            except ValueError:
+                logger.warning("[%s] Invalid datetime format for stamp, using current time", request_id)
                 stamp = datetime.now()
-
-            # Build transaction payload with database data
-            transaction_payload = {
-                "uniqueTranId": transaction_id,
-                "routing": "121000358",
-                "accountNumber": "5428610017522",
-                "checkAmount": float(transaction_data.get('total_amount', 0)),
-                "secCode": transaction_data.get('ach_trans_type', 'POS'),
-                "posTransactionDate": stamp.isoformat() + "Z",
-                "posTerminalId": str(transaction_data.get('terminal_id', '')),
-                "posTransactionSerialNumber": transaction_data.get('serial_number', ''),
-                "posAuthorizationCode": str(transaction_data.get('approval_code', '')),
-                "lastName": transaction_data.get('lname', ''),
-                "firstName": transaction_data.get('fname', ''),
-                "address1": transaction_data.get('address1', ''),
-                "city": transaction_data.get('city', ''),
-                "state": transaction_data.get('state', ''),
-                "zip": transaction_data.get('zip', ''),
-                "phone": transaction_data.get('home_phone') or transaction_data.get('mobile_phone', ''),
-                "checkDate": stamp.isoformat() + "Z",
-                "customDescriptor": transaction_data.get('ach_statement_id', ''),
-                # Additional fields that may be required by Payliance API
-                "posCardTransactionTypeCode": "01",
-                "posTerminalLocationAddress": transaction_data.get('merchant_address', ''),
-                "posTerminalCity": transaction_data.get('merchant_city', ''),
-                "posTerminalState": transaction_data.get('merchant_state', ''),
-                "posReferenceInfo1": transaction_data.get('consumer_id', ''),
-                "posReferenceInfo2": "00",
-                "accountType": "Personal Checking",
-                "address2": transaction_data.get('address2', ''),
-                "isSameDay": False,
-                "futureDate": "",
-                "microEntry": False,
-                "convenienceFee": False,
-                "convenienceFeeAmount": 0
-            }
+        elif not stamp:
+            stamp = datetime.now()
+
+        # Payliance expects naive UTC with a 'Z' suffix, not an offset
+        if stamp.tzinfo is not None:
+            stamp = stamp.astimezone(timezone.utc).replace(tzinfo=None)
+        stamp_iso = stamp.isoformat() + "Z"
+        terminal_id = transaction_data.terminal_id
+        approval_code = transaction_data.approval_code
+
+        # Build transaction payload: static template plus request-specific fields
+        transaction_payload = _PAYLIANCE_PAYLOAD_TEMPLATE.copy()
+        transaction_payload.update({
+            "uniqueTranId": transaction_id,
+            "checkAmount": float(transaction_data.total_amount),
+            "secCode": transaction_data.ach_trans_type,
+            "posTransactionDate": stamp_iso,
+            "posTerminalId": str(terminal_id) if terminal_id is not None else "",
+            "posTransactionSerialNumber": str(transaction_id)[-6:],
+            "posAuthorizationCode": str(approval_code) if approval_code is not None else "",
+            "lastName": transaction_data.lname,
+            "firstName": transaction_data.fname,
+            "address1": transaction_data.address1,
+            "city": transaction_data.city,
+            "state": transaction_data.state,
+            "zip": transaction_data.zip,
+            "phone": transaction_data.home_phone or transaction_data.mobile_phone,
+            "checkDate": stamp_iso,
+            "customDescriptor": transaction_data.ach_statement_id,
+            "posTerminalLocationAddress": transaction_data.merchant_address,
+            "posTerminalCity": transaction_data.merchant_city,
+            "posTerminalState": transaction_data.merchant_state,
+            "posReferenceInfo1": transaction_data.consumer_id,
+            "address2": transaction_data.address2
+        })
 
         # Prepare headers
-        url = f"{payliance_base_url}/api/v1/echeck/debit"
-        headers = {
-            'accept': 'text/plain',
-            'Authorization': f'Bearer {auth_token}',
-            'Content-Type': 'application/json',
-            'X-Request-ID': request_id
-        }
+        headers = [*_PAYLIANCE_HEADERS_BASE, ('X-Request-ID', request_id)]
 
-        logger.info(f"[{request_id}] Calling Payliance API: {url}")
+        logger.debug("[%s] Calling Payliance API: %s", request_id, _DEBIT_URL)
 
         # Make HTTP call to Payliance API
-        timeout = httpx.Timeout(timeout=30.0, connect=10.0)
-        async with httpx.AsyncClient(timeout=timeout, verify=True) as client:
-            response = await client.post(url, headers=headers, json=transaction_payload)
+        # Serialized with orjson; Content-Type is already in the headers
+        response = await get_client().post(_DEBIT_URL, headers=headers, content=orjson.dumps(transaction_payload))
 
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
+        processing_time = _elapsed_ms(start_ns)
 
         # Process response
         if response.status_code == 200:
-            logger.info(f"[{request_id}] SUCCESS: Transaction {transaction_id} processed in {processing_time:.2f}ms")
+            # Work from the raw bytes: one JSON parse, one UTF-8 decode for the echo
+            body_bytes = response.content
+            response_text = body_bytes.decode("utf-8", errors="replace")
 
             # Extract AuthorizationId from response and update database
             try:
-                response_data = json.loads(response.text)
+                response_data = orjson.loads(body_bytes)
+                if not isinstance(response_data, dict):
+                    response_data = {}
                 authorization_id = response_data.get('AuthorizationId')
                 validation_code = response_data.get('ValidationCode')
                 validation_message = response_data.get('message')
 
-                if authorization_id and db.connection_pool:
-                    logger.warning(f"[{request_id}] Received ValidationCode ({validation_code}) with message {validation_message} ")
+                if authorization_id:
+                    logger.warning("[%s] Received ValidationCode (%s) with message %s ", request_id, validation_code, validation_message)
 
                     # Update the payliance auth code in database
-                    insert_success = await db.insert_transaction_event(
-                        transaction_id=transaction_id,
-                        settled_log_id=datetime.now().strftime('%y%m%d%H'),
-                        created_by=9998,
-                        payliance_auth_id=authorization_id
-                    )
-
-                    if insert_success:
-                        logger.info(f"[{request_id}] Record inserted with AuthorizationId: {authorization_id} in events")
-
-                elif not authorization_id:
-                    logger.warning(f"[{request_id}] No AuthorizationId found in response")
-                elif not db.connection_pool:
-                    logger.warning(f"[{request_id}] Database connection not available to insert record")
-
-            except json.JSONDecodeError:
-                logger.warning(f"[{request_id}] Response is not valid JSON, cannot extract AuthorizationId")
+                    if ASYNC_EVENT_INSERT:
+                        task = asyncio.create_task(
+                            _record_transaction_event(transaction_id, authorization_id, request_id)
+                        )
+                        _background_tasks.add(task)
+                        task.add_done_callback(_background_tasks.discard)
+                    else:
+                        await _record_transaction_event(transaction_id, authorization_id, request_id)
+
+                else:
+                    logger.warning("[%s] No AuthorizationId found in response", request_id)
+
+            except orjson.JSONDecodeError:
+                logger.warning("[%s] Response is not valid JSON, cannot extract AuthorizationId", request_id)
             except Exception as e:
-                logger.error(f"[{request_id}] Error inserting record in database: {str(e)}")
+                logger.error("[%s] Error inserting record in database: %s", request_id, e)
 
-            return func.HttpResponse(
-                json.dumps({
+            return {
+                "success": True,
+                "status_code": response.status_code,
+                "body": {
                     "success": True,
                     "status_code": response.status_code,
-                    "response_data": response.text,
+                    "response_data": response_text,
                     "transaction_id": transaction_id,
                     "request_id": request_id,
                     "processing_time_ms": processing_time,
-                }),
-                status_code=200,
-                mimetype="application/json"
-            )
+                }
+            }
         else:
             # Classify error based on status code and response
+            # (logged once, with the response text, by the DebitError handler below)
             error_type = classify_error(Exception(f"HTTP {response.status_code}"), response.status_code)
             error_msg = f"API ERROR: Transaction {transaction_id} failed with status {response.status_code}"
 
-            logger.warning(f"[{request_id}] {error_msg}")
-            logger.warning(f"[{request_id}] Error classified as: {error_type.value}")
-            logger.warning(f"[{request_id}] Response: {response.text}")
-
             # For non-200 responses, raise appropriate exception to trigger retry logic
-            if error_type == ErrorType.TRANSIENT:
+            if error_type is ErrorType.TRANSIENT:
                 raise DebitError(f"{error_msg}: {response.text}", ErrorType.TRANSIENT, response.status_code)
             else:
                 raise DebitError(f"{error_msg}: {response.text}", ErrorType.PERMANENT, response.status_code)
 
     except DebitError as e:
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
-        logger.error(f"[{request_id}] DEBIT ERROR for transaction {transaction_id}: {str(e)}")
-        logger.error(f"[{request_id}] Error type: {e.error_type.value}")
+        processing_time = _elapsed_ms(start_ns)
+        error_type = e.error_type
+        et_value = error_type.value
+        logger.error("[%s] DEBIT ERROR (%s) for transaction %s: %s", request_id, et_value, transaction_id, e)
 
         # Return appropriate status code based on error type
-        if e.error_type == ErrorType.PERMANENT:
+        if error_type is ErrorType.PERMANENT:
             status_code = e.status_code or 400
         else:
             status_code = e.status_code or 500
 
-        return func.HttpResponse(
-            json.dumps({
+        return {
+            "success": False,
+            "status_code": status_code,
+            "error_type": error_type,
+            "body": {
                 "success": False,
                 "error": str(e),
-                "error_type": e.error_type.value,
+                "error_type": et_value,
                 "transaction_id": transaction_id,
                 "request_id": request_id,
                 "processing_time_ms": processing_time
-            }),
-            status_code=status_code,
-            mimetype="application/json"
-        )
+            }
+        }
 
-    except (httpx.TimeoutException, asyncio.TimeoutError) as e:
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
-        logger.error(f"[{request_id}] TIMEOUT ERROR for transaction {transaction_id}: {str(e)}")
-        logger.error(f"[{request_id}] Error classified as: {ErrorType.TRANSIENT.value}")
-        return func.HttpResponse(
-            json.dumps({
-                "success": False,
-                "error": "Request timeout - Payliance API did not respond within 30 seconds",
-                "error_type": ErrorType.TRANSIENT.value,
-                "transaction_id": transaction_id,
-                "request_id": request_id,
-                "processing_time_ms": processing_time
-            }),
-            status_code=408,
-            mimetype="application/json"
-        )
+    except Exception as e:
+        return _error_result_for(e, transaction_id, request_id, _elapsed_ms(start_ns))
 
-    except httpx.HTTPStatusError as e:
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
-        error_type = classify_error(e, getattr(e.response, 'status_code', None) if hasattr(e, 'response') else None)
-        logger.error(f"[{request_id}] HTTP ERROR for transaction {transaction_id}: {str(e)}")
-        logger.error(f"[{request_id}] Error classified as: {error_type.value}")
+@app.function_name(name="PaylianceDebitFunction")
+@app.route(route="debit", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
+async def payliance_debit_function(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Azure Function to process Payliance debit transactions
 
-        status_code = getattr(e.response, 'status_code', 500) if hasattr(e, 'response') else 500
-        return func.HttpResponse(
-            json.dumps({
-                "success": False,
-                "error": f"HTTP error from Payliance API: {str(e)}",
-                "error_type": error_type.value,
-                "transaction_id": transaction_id,
-                "request_id": request_id,
-                "processing_time_ms": processing_time
-            }),
-            status_code=status_code,
-            mimetype="application/json"
-        )
+    Expects JSON body with:
+    {
+        "transaction_id": "string"
+    }
+    """
 
-    except (httpx.ConnectError, httpx.NetworkError, httpx.ConnectTimeout) as e:
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
-        logger.error(f"[{request_id}] NETWORK ERROR for transaction {transaction_id}: {str(e)}")
-        logger.error(f"[{request_id}] Error classified as: {ErrorType.TRANSIENT.value}")
-        return func.HttpResponse(
-            json.dumps({
-                "success": False,
-                "error": f"Network error connecting to Payliance API: {str(e)}",
-                "error_type": ErrorType.TRANSIENT.value,
-                "transaction_id": transaction_id,
-                "request_id": request_id,
-                "processing_time_ms": processing_time
-            }),
-            status_code=503,
-            mimetype="application/json"
-        )
+    request_id = uuid.uuid4().hex
+    start_ns = time.perf_counter_ns()
 
-    except httpx.RequestError as e:
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
-        error_type = classify_error(e)
-        logger.error(f"{request_id}] REQUEST ERROR for transaction {transaction_id}: {str(e)}")
-        logger.error(f"[{request_id}] Error classified as: {error_type.value}")
+    # Get request body
+    try:
+        req_body = orjson.loads(req.get_body())
+    except orjson.JSONDecodeError:
+        req_body = None
+    transaction_id = req_body.get('transaction_id') if isinstance(req_body, dict) else None
 
-        status_code = 500 if error_type == ErrorType.TRANSIENT else 400
-        return func.HttpResponse(
-            json.dumps({
-                "success": False,
-                "error": f"Failed to call Payliance API: {str(e)}",
-                "error_type": error_type.value,
-                "transaction_id": transaction_id,
-                "request_id": request_id,
-                "processing_time_ms": processing_time
-            }),
-            status_code=status_code,
-            mimetype="application/json"
-        )
+    if not transaction_id:
+        logger.error("[%s] transaction_id is required", request_id)
+        result = _error_result(400, "transaction_id is required", request_id)
+    else:
+        result = await _run_to_completion(process_debit(transaction_id, request_id))
 
-    except Exception as e:
-        processing_time = (datetime.now() - start_time).total_seconds() * 1000
-        error_type = classify_error(e)
-        logger.error(f"[{request_id}] UNEXPECTED ERROR for transaction {transaction_id}: {str(e)}")
-        logger.error(f"[{request_id}] Error classified as: {error_type.value}")
+    _log_debit_summary(request_id, transaction_id, result, _elapsed_ms(start_ns))
 
-        status_code = 500 if error_type == ErrorType.TRANSIENT else 400
-        return func.HttpResponse(
-            json.dumps({
-                "success": False,
-                "error": f"Unexpected error: {str(e)}",
-                "error_type": error_type.value,
-                "transaction_id": transaction_id,
-                "request_id": request_id,
-                "processing_time_ms": processing_time
-            }),
-            status_code=status_code,
-            mimetype="application/json"
-        )
+    return _json_response(result["body"], result["status_code"])
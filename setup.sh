@@ -13,11 +13,11 @@ python_version=$(python3 --version 2>&1 | cut -d' ' -f2)
 echo "   Python version: $python_version"
 
 # Check if required Python version
-required_version="3.8"
-if python3 -c "import sys; exit(0 if sys.version_info >= (3, 8) else 1)"; then
+required_version="3.9"
+if python3 -c "import sys; exit(0 if sys.version_info >= (3, 9) else 1)"; then
     echo "✅ Python version is compatible"
 else
-    echo "❌ Python 3.8 or higher is required"
+    echo "❌ Python 3.9 or higher is required"
     exit 1
 fi
 
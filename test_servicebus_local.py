@@ -14,19 +14,19 @@ Usage:
 """
 
 import asyncio
-import json
 import logging
 import os
 import sys
 import time
 import uuid
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timezone
+from typing import List, Optional
 import argparse
 
 try:
     from azure.servicebus import ServiceBusClient, ServiceBusMessage
     from azure.servicebus.exceptions import ServiceBusError
+    from azure.servicebus.management import ServiceBusAdministrationClient
 except ImportError:
     print("❌ azure-servicebus package not installed. Run: pip install azure-servicebus")
     sys.exit(1)
@@ -37,6 +37,19 @@ except ImportError:
     print("❌ httpx package not installed. Run: pip install httpx")
     sys.exit(1)
 
+try:
+    import orjson
+except ImportError:
+    print("❌ orjson package not installed. Run: pip install orjson")
+    sys.exit(1)
+
+try:
+    # Optional faster event loop; the stdlib loop is used when it is not installed
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -49,6 +62,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Shared health-check client, reused across checks on the script's event loop.
+# HTTP/2 is negotiated via TLS ALPN, so it only applies when FUNCTION_APP_URL is https
+_HEALTH_TIMEOUT = httpx.Timeout(timeout=10.0, connect=5.0)
+_HEALTH_CLIENT = httpx.AsyncClient(timeout=_HEALTH_TIMEOUT, http2=True)
+
 class ServiceBusLocalTester:
     def __init__(self):
         self.connection_string = os.environ.get('ServiceBusConnection')
@@ -60,31 +78,76 @@ class ServiceBusLocalTester:
             logger.info("Please update your local.settings.json or .env file with a valid Service Bus connection string")
             sys.exit(1)
 
+        # One client and sender for the tester's lifetime so the AMQP connection
+        # and link are set up once instead of per message
+        self._sb_client = ServiceBusClient.from_connection_string(self.connection_string)
+        self._sender = self._sb_client.get_queue_sender(queue_name=self.queue_name)
+
+    def close(self) -> None:
+        """Close the Service Bus sender and client"""
+        self._sender.close()
+        self._sb_client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def send_test_message(self, transaction_id: Optional[str] = None) -> bool:
         """Send a test message to the Service Bus queue"""
-        if not transaction_id:
-
-            message_data = {
-                "transaction_id": "1234567",
-                "timestamp": datetime.now().isoformat(),
-                "test": True
-            }
-        else:
-            message_data = {
-                "transaction_id": transaction_id,
-                "timestamp": datetime.now().isoformat(),
-                "test": True
-            }
+        message_data = {
+            "transaction_id": transaction_id or "1234567",
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "test": True
+        }
 
         try:
-            with ServiceBusClient.from_connection_string(self.connection_string) as client:
-                sender = client.get_queue_sender(queue_name=self.queue_name)
-                with sender:
-                    message = ServiceBusMessage(json.dumps(message_data))
-                    sender.send_messages(message)
-                    logger.info(f"✅ Sent test message for transaction: {transaction_id}")
-                    logger.info(f"   Message data: {json.dumps(message_data, indent=2)}")
-                    return True
+            message = ServiceBusMessage(orjson.dumps(message_data))
+            self._sender.send_messages(message)
+            logger.info(f"✅ Sent test message for transaction: {transaction_id}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("   Message data: %s", orjson.dumps(message_data, option=orjson.OPT_INDENT_2).decode())
+            return True
+        except ServiceBusError as e:
+            logger.error(f"❌ Service Bus error: {str(e)}")
+            return False
+        except Exception as e:
+            logger.error(f"❌ Unexpected error: {str(e)}")
+            return False
+
+    def send_batch(self, count: int, transaction_ids: Optional[List[str]] = None) -> bool:
+        """Send test messages to the Service Bus queue in as few batches as possible"""
+        if not transaction_ids:
+            transaction_ids = ["1234567"] * count
+
+        # One timestamp for the whole batch
+        timestamp = datetime.now(timezone.utc).isoformat()
+
+        try:
+            batch = self._sender.create_message_batch()
+            sent = 0
+            for transaction_id in transaction_ids[:count]:
+                message = ServiceBusMessage(orjson.dumps({
+                    "transaction_id": transaction_id,
+                    "timestamp": timestamp,
+                    "test": True
+                }))
+                try:
+                    batch.add_message(message)
+                except ValueError:
+                    # Batch is full - send it and start a new one
+                    self._sender.send_messages(batch)
+                    sent += len(batch)
+                    batch = self._sender.create_message_batch()
+                    batch.add_message(message)
+
+            if len(batch):
+                self._sender.send_messages(batch)
+                sent += len(batch)
+
+            logger.info(f"✅ Sent {sent} test messages in batches")
+            return True
         except ServiceBusError as e:
             logger.error(f"❌ Service Bus error: {str(e)}")
             return False
@@ -97,51 +160,49 @@ class ServiceBusLocalTester:
         url = f"{self.function_url}/api/health"
 
         try:
-            timeout = httpx.Timeout(timeout=10.0, connect=5.0)
-            async with httpx.AsyncClient(timeout=timeout, verify=False) as client:
-                response = await client.get(url)
-
-                if response.status_code == 200:
-                    logger.info(f"✅ Azure Function is healthy")
-                    return True
-                else:
-                    logger.warning(f"⚠️ Health check returned: {response.status_code}")
-                    return False
+            response = await _HEALTH_CLIENT.get(url)
+
+            if response.status_code == 200:
+                logger.info(f"✅ Azure Function is healthy")
+                return True
+            else:
+                logger.warning(f"⚠️ Health check returned: {response.status_code}")
+                return False
         except Exception as e:
             logger.error(f"❌ Cannot connect to Azure Function: {str(e)}")
             logger.info(f"   Make sure your function app is running on {self.function_url}")
             return False
 
-    def monitor_queue(self, duration: int = 30) -> None:
+    async def monitor_queue(self, duration: int = 30) -> None:
         """Monitor the Service Bus queue for messages"""
         logger.info(f"👀 Monitoring Service Bus queue '{self.queue_name}' for {duration} seconds...")
 
         try:
-            with ServiceBusClient.from_connection_string(self.connection_string) as client:
-                receiver = client.get_queue_receiver(queue_name=self.queue_name)
-                with receiver:
-                    start_time = time.time()
-                    message_count = 0
-
-                    while time.time() - start_time < duration:
-                        try:
-                            # Peek messages without consuming them
-                            messages = receiver.peek_messages(max_message_count=10)
-                            current_count = len(messages)
-
-                            if current_count != message_count:
-                                logger.info(f"📊 Queue has {current_count} pending messages")
-                                message_count = current_count
-
-                            time.sleep(2)
-                        except KeyboardInterrupt:
-                            logger.info("⏹️ Monitoring stopped by user")
-                            break
-                        except Exception as e:
-                            logger.error(f"❌ Error monitoring queue: {str(e)}")
-                            time.sleep(5)
-
-                    logger.info(f"✅ Monitoring complete. Final queue count: {message_count}")
+            # Queue depth comes from the runtime properties (one metadata call)
+            # instead of peeking message bodies, which also capped the count at 10.
+            # The sync client runs on the default executor so the loop stays free
+            loop = asyncio.get_running_loop()
+            with ServiceBusAdministrationClient.from_connection_string(self.connection_string) as admin_client:
+                start_time = time.monotonic()
+                message_count = None
+
+                while time.monotonic() - start_time < duration:
+                    try:
+                        properties = await loop.run_in_executor(
+                            None, admin_client.get_queue_runtime_properties, self.queue_name
+                        )
+                        current_count = properties.active_message_count
+
+                        if current_count != message_count:
+                            logger.info(f"📊 Queue has {current_count} pending messages")
+                            message_count = current_count
+
+                        await asyncio.sleep(2)
+                    except Exception as e:
+                        logger.error(f"❌ Error monitoring queue: {str(e)}")
+                        await asyncio.sleep(5)
+
+                logger.info(f"✅ Monitoring complete. Final queue count: {message_count}")
         except Exception as e:
             logger.error(f"❌ Failed to monitor queue: {str(e)}")
 
@@ -164,6 +225,7 @@ class ServiceBusLocalTester:
 
 4. Run tests:
    python test_servicebus_local.py --send-message
+   python test_servicebus_local.py --send-batch 5
    python test_servicebus_local.py --monitor
 
 🔍 TROUBLESHOOTING:
@@ -173,9 +235,17 @@ class ServiceBusLocalTester:
 - Check function app logs for any errors
         """)
 
+def _positive_int(value: str) -> int:
+    """argparse type for counts that must be at least 1"""
+    count = int(value)
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {count}")
+    return count
+
 def main():
     parser = argparse.ArgumentParser(description='Test Azure Service Bus integration locally')
     parser.add_argument('--send-message', action='store_true', help='Send a single test message')
+    parser.add_argument('--send-batch', type=_positive_int, metavar='N', help='Send N test messages in batches')
     parser.add_argument('--monitor', action='store_true', help='Monitor the Service Bus queue')
     parser.add_argument('--health-check', action='store_true', help='Check function app health')
     parser.add_argument('--setup', action='store_true', help='Show setup instructions')
@@ -183,17 +253,27 @@ def main():
 
     args = parser.parse_args()
 
-    tester = ServiceBusLocalTester()
-
-    if args.setup:
-        tester.print_setup_instructions()
-        return
-
-    # Check function health first (keep this async)
-    async def run_health_check():
-        return await tester.check_function_health()
+    with ServiceBusLocalTester() as tester:
+        if args.setup:
+            tester.print_setup_instructions()
+            return
 
-    health_ok = asyncio.run(run_health_check())
+        # One event loop for the whole run
+        try:
+            asyncio.run(run_tests(tester, args))
+        except KeyboardInterrupt:
+            logger.info("⏹️ Monitoring stopped by user")
+
+async def run_tests(tester: ServiceBusLocalTester, args: argparse.Namespace) -> None:
+    """Run the selected tests on a single event loop"""
+    try:
+        await _run_tests(tester, args)
+    finally:
+        await _HEALTH_CLIENT.aclose()
+
+async def _run_tests(tester: ServiceBusLocalTester, args: argparse.Namespace) -> None:
+    # Check function health first
+    health_ok = await tester.check_function_health()
     if not health_ok:
         logger.warning("⚠️ Function app doesn't seem to be running. Some tests may fail.")
         print("Run: func start --port 7071")
@@ -201,25 +281,25 @@ def main():
             return
 
     if args.health_check:
-        asyncio.run(run_health_check())
+        return
     elif args.send_message:
         tester.send_test_message(args.transaction_id)
+    elif args.send_batch is not None:
+        transaction_ids = [args.transaction_id] * args.send_batch if args.transaction_id else None
+        tester.send_batch(args.send_batch, transaction_ids)
     elif args.monitor:
-        tester.monitor_queue()
+        await tester.monitor_queue()
     else:
-        # Default: run a comprehensive test
+        # Default: run a comprehensive test (health check already done above)
         logger.info("🧪 Running comprehensive Service Bus test...")
 
-        # 1. Health check
-        asyncio.run(run_health_check())
-
-        # 2. Send test message
+        # Send test message and watch the queue drain while it is processed
         logger.info("\n" + "="*50)
-        tester.send_test_message()
-
-        # 3. Wait a bit for processing
-        logger.info("\n⏳ Waiting 5 seconds for message processing...")
-        time.sleep(5)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            loop.run_in_executor(None, tester.send_test_message),
+            tester.monitor_queue(5)
+        )
 
         logger.info("\n✅ Test complete! Check your function app logs for processing details.")
 